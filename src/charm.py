@@ -1,116 +1,306 @@
 #!/usr/bin/env python3
 
+import hashlib
+import ipaddress
 import json
 import logging
 import os
+import tempfile
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
-from subprocess import check_call
 
 import yaml
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
 from ops.charm import CharmBase
+from ops.framework import StoredState
 from ops.main import main
 from ops.model import ActiveStatus, Application, MaintenanceStatus
 
 from charmhelpers.core import hookenv
 from oci_image import OCIImageResource, OCIImageResourceError
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 logger = logging.getLogger(__name__)
 
+SIGNING_ALGORITHM = hashes.SHA256()
+
+# Certs are regenerated once they get this close to expiring
+RENEW_BEFORE = timedelta(days=30)
+
+# Where older revisions of this charm kept their certs, which doesn't survive pod restarts
+LEGACY_CERTS_DIR = Path("/run")
+CERT_FILES = ["ca.key", "ca.crt", "server.key", "cert.pem"]
+
+
+def load_crds():
+    return [
+        {"name": crd["metadata"]["name"], "spec": crd["spec"]}
+        for crd in yaml.load_all(Path("src/crds.yaml").read_text(), Loader=SafeLoader)
+    ]
+
+
+def gen_certs(namespace, service_name, certs_dir):
+    """Returns the server cert, server key and CA cert as PEM strings.
+
+    Reuses the ones already in certs_dir, and only generates new ones if any of them are missing or
+    unreadable, or the server cert doesn't match its key, is about to expire or doesn't cover the
+    service's DNS names.
+    """
+
+    if not certs_dir.exists():
+        certs_dir.mkdir(mode=0o700, parents=True)
+        migrate_legacy_certs(certs_dir)
+
+    paths = {
+        "cert": certs_dir / "cert.pem",
+        "key": certs_dir / "server.key",
+        "ca": certs_dir / "ca.crt",
+    }
+
+    if all(path.exists() for path in paths.values()):
+        pems = {name: path.read_bytes() for name, path in paths.items()}
+        if is_reusable(pems, namespace, service_name):
+            hookenv.log("Found existing cert.pem, not generating new cert.")
+            return {name: pem.decode("ascii") for name, pem in pems.items()}
+        hookenv.log("Existing cert.pem is stale, generating new cert.")
+
+    # The server key doesn't depend on the CA, so generate it in the background while the CA is
+    # loaded or generated. OpenSSL releases the GIL, so both keygens can run in parallel.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        server_key = executor.submit(gen_key)
+        ca_key, ca_cert = ensure_ca(certs_dir)
+        cert, key = issue_server_cert(
+            namespace, service_name, ca_key, ca_cert, server_key.result(), certs_dir
+        )
+
+    return {
+        "cert": cert,
+        "key": key,
+        "ca": ca_cert.public_bytes(serialization.Encoding.PEM).decode("ascii"),
+    }
+
+
+def migrate_legacy_certs(certs_dir):
+    """Copies certs left in LEGACY_CERTS_DIR by older revisions into a new certs_dir.
+
+    This keeps the cert the workload is already serving across an upgrade. The copies go through
+    the usual reuse checks, so anything broken is still regenerated.
+    """
+
+    # CERT_FILES ends with cert.pem, which marks the copied set as complete
+    for name in CERT_FILES:
+        legacy_path = LEGACY_CERTS_DIR / name
+        if legacy_path.exists():
+            hookenv.log(f"Migrating {legacy_path} to {certs_dir}.")
+            write_private(certs_dir / name, legacy_path.read_bytes())
+
+
+def gen_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def load_cert(pem):
+    try:
+        return x509.load_pem_x509_certificate(pem)
+    except ValueError:
+        return None
+
+
+def load_key(pem):
+    try:
+        return serialization.load_pem_private_key(pem, None)
+    except (TypeError, ValueError):
+        return None
+
+
+def key_matches(cert, key):
+    return cert.public_key().public_numbers() == key.public_key().public_numbers()
+
+
+def is_reusable(pems, namespace, service_name):
+    """Checks whether the cached cert, key and CA PEMs can be handed out as they are."""
+
+    cert = load_cert(pems["cert"])
+    key = load_key(pems["key"])
+    if cert is None or key is None or load_cert(pems["ca"]) is None:
+        return False
 
-def gen_certs(namespace, service_name):
-    if Path("/run/cert.pem").exists():
-        hookenv.log("Found existing cert.pem, not generating new cert.")
-        return
-
-    Path("/run/ssl.conf").write_text(
-        f"""[ req ]
-default_bits = 2048
-prompt = no
-default_md = sha256
-req_extensions = req_ext
-distinguished_name = dn
-[ dn ]
-C = GB
-ST = Canonical
-L = Canonical
-O = Canonical
-OU = Canonical
-CN = 127.0.0.1
-[ req_ext ]
-subjectAltName = @alt_names
-[ alt_names ]
-DNS.1 = {service_name}
-DNS.2 = {service_name}.{namespace}
-DNS.3 = {service_name}.{namespace}.svc
-DNS.4 = {service_name}.{namespace}.svc.cluster
-DNS.5 = {service_name}.{namespace}.svc.cluster.local
-IP.1 = 127.0.0.1
-[ v3_ext ]
-authorityKeyIdentifier=keyid,issuer:always
-basicConstraints=CA:FALSE
-keyUsage=keyEncipherment,dataEncipherment,digitalSignature
-extendedKeyUsage=serverAuth,clientAuth
-subjectAltName=@alt_names"""
+    return (
+        key_matches(cert, key)
+        and not expires_soon(cert)
+        and covers_service(cert, namespace, service_name)
     )
 
-    check_call(["openssl", "genrsa", "-out", "/run/ca.key", "2048"])
-    check_call(["openssl", "genrsa", "-out", "/run/server.key", "2048"])
-    check_call(
-        [
-            "openssl",
-            "req",
-            "-x509",
-            "-new",
-            "-sha256",
-            "-nodes",
-            "-days",
-            "3650",
-            "-key",
-            "/run/ca.key",
-            "-subj",
-            "/CN=127.0.0.1",
-            "-out",
-            "/run/ca.crt",
-        ]
+
+def expires_soon(cert):
+    return cert.not_valid_after - RENEW_BEFORE < datetime.utcnow()
+
+
+def service_dns_names(namespace, service_name):
+    return [
+        service_name,
+        f"{service_name}.{namespace}",
+        f"{service_name}.{namespace}.svc",
+        f"{service_name}.{namespace}.svc.cluster",
+        f"{service_name}.{namespace}.svc.cluster.local",
+    ]
+
+
+def covers_service(cert, namespace, service_name):
+    try:
+        sans = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    except x509.ExtensionNotFound:
+        return False
+    return set(service_dns_names(namespace, service_name)).issubset(
+        sans.get_values_for_type(x509.DNSName)
     )
-    check_call(
-        [
-            "openssl",
-            "req",
-            "-new",
-            "-sha256",
-            "-key",
-            "/run/server.key",
-            "-out",
-            "/run/server.csr",
-            "-config",
-            "/run/ssl.conf",
-        ]
+
+
+def write_private(path, data):
+    """Atomically replaces path with data, readable only by the owner.
+
+    The data is written to a temporary file next to path and renamed over it, so an interrupted
+    write never leaves a truncated file behind.
+    """
+
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def key_to_pem(key):
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption(),
     )
-    check_call(
+
+
+def ensure_ca(certs_dir):
+    """Returns the CA key and certificate, generating them if they don't exist yet."""
+
+    key_path = certs_dir / "ca.key"
+    cert_path = certs_dir / "ca.crt"
+
+    if key_path.exists() and cert_path.exists():
+        ca_cert = load_cert(cert_path.read_bytes())
+        ca_key = load_key(key_path.read_bytes())
+        valid = ca_cert is not None and ca_key is not None and key_matches(ca_cert, ca_key)
+        if valid and not expires_soon(ca_cert):
+            hookenv.log("Found existing CA, not generating new CA.")
+            return ca_key, ca_cert
+        hookenv.log("Existing CA is stale, generating new CA.")
+
+    ca_key = gen_key()
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.utcnow()
+    ca_cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(ca_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + timedelta(days=3650))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .add_extension(
+            x509.SubjectKeyIdentifier.from_public_key(ca_key.public_key()),
+            critical=False,
+        )
+        .sign(ca_key, SIGNING_ALGORITHM)
+    )
+
+    # Write the cert last, as its presence is what marks the CA as usable
+    write_private(key_path, key_to_pem(ca_key))
+    write_private(cert_path, ca_cert.public_bytes(serialization.Encoding.PEM))
+
+    return ca_key, ca_cert
+
+
+def issue_server_cert(namespace, service_name, ca_key, ca_cert, server_key, certs_dir):
+    """Issues a certificate for the server key, signed by the CA.
+
+    Returns the certificate and the key as PEM strings.
+    """
+
+    subject = x509.Name(
         [
-            "openssl",
-            "x509",
-            "-req",
-            "-sha256",
-            "-in",
-            "/run/server.csr",
-            "-CA",
-            "/run/ca.crt",
-            "-CAkey",
-            "/run/ca.key",
-            "-CAcreateserial",
-            "-out",
-            "/run/cert.pem",
-            "-days",
-            "365",
-            "-extensions",
-            "v3_ext",
-            "-extfile",
-            "/run/ssl.conf",
+            x509.NameAttribute(NameOID.COUNTRY_NAME, "GB"),
+            x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "Canonical"),
+            x509.NameAttribute(NameOID.LOCALITY_NAME, "Canonical"),
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Canonical"),
+            x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "Canonical"),
+            x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1"),
         ]
     )
+    now = datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(ca_cert.subject)
+        .public_key(server_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + timedelta(days=365))
+        .add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_key.public_key()),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=False)
+        .add_extension(
+            x509.KeyUsage(
+                digital_signature=True,
+                content_commitment=False,
+                key_encipherment=True,
+                data_encipherment=True,
+                key_agreement=False,
+                key_cert_sign=False,
+                crl_sign=False,
+                encipher_only=False,
+                decipher_only=False,
+            ),
+            critical=False,
+        )
+        .add_extension(
+            x509.ExtendedKeyUsage(
+                [ExtendedKeyUsageOID.SERVER_AUTH, ExtendedKeyUsageOID.CLIENT_AUTH]
+            ),
+            critical=False,
+        )
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.DNSName(name) for name in service_dns_names(namespace, service_name)]
+                + [x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            critical=False,
+        )
+        .sign(ca_key, SIGNING_ALGORITHM)
+    )
+
+    key_pem = key_to_pem(server_key)
+    cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+
+    # Write the cert last, as gen_certs only reuses the key once cert.pem is present
+    write_private(certs_dir / "server.key", key_pem)
+    write_private(certs_dir / "cert.pem", cert_pem)
+
+    return cert_pem.decode("ascii"), key_pem.decode("ascii")
 
 
 class AdmissionWebhookCharm(CharmBase):
@@ -120,26 +310,44 @@ class AdmissionWebhookCharm(CharmBase):
     into Kubeflow pods.
     """
 
+    _stored = StoredState()
+
     def __init__(self, framework):
         super().__init__(framework)
+        self._stored.set_default(spec_hash=None)
         self.image = OCIImageResource(self, "oci-image")
+        self._service_name = hookenv.service_name()
+        # Lives next to the charm in the unit agent's directory, which is on the operator pod's
+        # persistent storage, so certs survive operator pod restarts
+        self._certs_dir = self.charm_dir.parent / "certs"
         self.framework.observe(self.on.install, self.set_pod_spec)
-        self.framework.observe(self.on.upgrade_charm, self.set_pod_spec)
+        self.framework.observe(self.on.upgrade_charm, self.force_pod_spec)
+        self.framework.observe(self.on.leader_elected, self.force_pod_spec)
+        self.framework.observe(self.on.config_changed, self.set_pod_spec)
+        # Runs periodically, so certs get renewed before they expire even if nothing else happens
+        self.framework.observe(self.on.update_status, self.set_pod_spec)
         self.framework.observe(
             self.on.pod_defaults_relation_changed,
             self.set_pod_spec,
         )
 
+    def force_pod_spec(self, event):
+        """Sets the pod spec even if it matches the last one this unit applied.
+
+        The pod spec belongs to the application, so another leader may have replaced it since.
+        """
+
+        self._stored.spec_hash = None
+        self.set_pod_spec(event)
+
     def set_pod_spec(self, event):
         if not self.model.unit.is_leader():
             logger.info("Not a leader, skipping set_pod_spec")
             self.model.unit.status = ActiveStatus()
             return
 
-        self.model.unit.status = MaintenanceStatus("Setting pod spec")
-
         pod_defaults = {
-            key.name: dict(value)["pod-defaults"]
+            key.name: json.loads(value["pod-defaults"])
             for relation in self.model.relations["pod-defaults"]
             for key, value in relation.data.items()
             if isinstance(key, Application) and not key._is_our_app
@@ -160,7 +368,7 @@ class AdmissionWebhookCharm(CharmBase):
                     },
                 }
                 for charm, defaults in pod_defaults.items()
-                for name, value in json.loads(defaults).items()
+                for name, value in defaults.items()
             ],
         }
 
@@ -172,120 +380,129 @@ class AdmissionWebhookCharm(CharmBase):
 
         model = os.environ["JUJU_MODEL_NAME"]
 
-        gen_certs(model, hookenv.service_name())
+        certs = gen_certs(model, self._service_name, self._certs_dir)
 
-        ca_bundle = b64encode(Path("/run/cert.pem").read_bytes()).decode("utf-8")
+        ca_bundle = b64encode(certs["cert"].encode("ascii")).decode("ascii")
 
-        self.model.pod.set_spec(
-            {
-                "version": 3,
-                "serviceAccount": {
-                    "roles": [
+        spec = {
+            "version": 3,
+            "serviceAccount": {
+                "roles": [
+                    {
+                        "global": True,
+                        "rules": [
+                            {
+                                "apiGroups": ["kubeflow.org"],
+                                "resources": ["poddefaults"],
+                                "verbs": [
+                                    "get",
+                                    "list",
+                                    "watch",
+                                    "update",
+                                    "create",
+                                    "patch",
+                                    "delete",
+                                ],
+                            },
+                        ],
+                    }
+                ],
+            },
+            "containers": [
+                {
+                    "name": "admission-webhook",
+                    "imageDetails": image_details,
+                    "ports": [{"name": "webhook", "containerPort": 443}],
+                    "volumeConfig": [
                         {
-                            "global": True,
-                            "rules": [
+                            "name": "certs",
+                            "mountPath": "/etc/webhook/certs",
+                            "files": [
+                                {
+                                    "path": "cert.pem",
+                                    "content": certs["cert"],
+                                },
                                 {
-                                    "apiGroups": ["kubeflow.org"],
-                                    "resources": ["poddefaults"],
-                                    "verbs": [
-                                        "get",
-                                        "list",
-                                        "watch",
-                                        "update",
-                                        "create",
-                                        "patch",
-                                        "delete",
-                                    ],
+                                    "path": "key.pem",
+                                    "content": certs["key"],
                                 },
                             ],
                         }
                     ],
-                },
-                "containers": [
+                }
+            ],
+        }
+
+        k8s_resources = {
+            "kubernetesResources": {
+                "customResourceDefinitions": load_crds(),
+                "customResources": custom_resources,
+                "mutatingWebhookConfigurations": [
                     {
                         "name": "admission-webhook",
-                        "imageDetails": image_details,
-                        "ports": [{"name": "webhook", "containerPort": 443}],
-                        "volumeConfig": [
+                        "webhooks": [
                             {
-                                "name": "certs",
-                                "mountPath": "/etc/webhook/certs",
-                                "files": [
-                                    {
-                                        "path": "cert.pem",
-                                        "content": Path("/run/cert.pem").read_text(),
+                                "name": "admission-webhook.kubeflow.org",
+                                "failurePolicy": "Fail",
+                                "clientConfig": {
+                                    "caBundle": ca_bundle,
+                                    "service": {
+                                        "name": self._service_name,
+                                        "namespace": model,
+                                        "path": "/apply-poddefault",
                                     },
+                                },
+                                "objectSelector": {
+                                    "matchExpressions": [
+                                        {
+                                            "key": "juju-app",
+                                            "operator": "NotIn",
+                                            "values": ["admission-webhook"],
+                                        },
+                                        {
+                                            "key": "app.kubernetes.io/name",
+                                            "operator": "NotIn",
+                                            "values": ["admission-webhook"],
+                                        },
+                                        {
+                                            "key": "juju-operator",
+                                            "operator": "NotIn",
+                                            "values": ["admission-webhook"],
+                                        },
+                                        {
+                                            "key": "operator.juju.is/name",
+                                            "operator": "NotIn",
+                                            "values": ["admission-webhook"],
+                                        },
+                                    ]
+                                },
+                                "rules": [
                                     {
-                                        "path": "key.pem",
-                                        "content": Path("/run/server.key").read_text(),
-                                    },
+                                        "apiGroups": [""],
+                                        "apiVersions": ["v1"],
+                                        "operations": ["CREATE"],
+                                        "resources": ["pods"],
+                                    }
                                 ],
-                            }
+                            },
                         ],
                     }
                 ],
-            },
-            k8s_resources={
-                "kubernetesResources": {
-                    "customResourceDefinitions": [
-                        {"name": crd["metadata"]["name"], "spec": crd["spec"]}
-                        for crd in yaml.safe_load_all(Path("src/crds.yaml").read_text())
-                    ],
-                    "customResources": custom_resources,
-                    "mutatingWebhookConfigurations": [
-                        {
-                            "name": "admission-webhook",
-                            "webhooks": [
-                                {
-                                    "name": "admission-webhook.kubeflow.org",
-                                    "failurePolicy": "Fail",
-                                    "clientConfig": {
-                                        "caBundle": ca_bundle,
-                                        "service": {
-                                            "name": hookenv.service_name(),
-                                            "namespace": model,
-                                            "path": "/apply-poddefault",
-                                        },
-                                    },
-                                    "objectSelector": {
-                                        "matchExpressions": [
-                                            {
-                                                "key": "juju-app",
-                                                "operator": "NotIn",
-                                                "values": ["admission-webhook"],
-                                            },
-                                            {
-                                                "key": "app.kubernetes.io/name",
-                                                "operator": "NotIn",
-                                                "values": ["admission-webhook"],
-                                            },
-                                            {
-                                                "key": "juju-operator",
-                                                "operator": "NotIn",
-                                                "values": ["admission-webhook"],
-                                            },
-                                            {
-                                                "key": "operator.juju.is/name",
-                                                "operator": "NotIn",
-                                                "values": ["admission-webhook"],
-                                            },
-                                        ]
-                                    },
-                                    "rules": [
-                                        {
-                                            "apiGroups": [""],
-                                            "apiVersions": ["v1"],
-                                            "operations": ["CREATE"],
-                                            "resources": ["pods"],
-                                        }
-                                    ],
-                                },
-                            ],
-                        }
-                    ],
-                }
-            },
-        )
+            }
+        }
+
+        spec_hash = hashlib.blake2b(
+            json.dumps([spec, k8s_resources], sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+        if spec_hash == self._stored.spec_hash:
+            logger.info("Pod spec unchanged, skipping set_spec")
+            self.model.unit.status = ActiveStatus()
+            return
+
+        self.model.unit.status = MaintenanceStatus("Setting pod spec")
+        self.model.pod.set_spec(spec, k8s_resources=k8s_resources)
+        self._stored.spec_hash = spec_hash
 
         self.model.unit.status = ActiveStatus()
 